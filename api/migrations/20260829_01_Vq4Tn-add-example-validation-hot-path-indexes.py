@@ -0,0 +1,26 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Add composite indexes covering the example validation hot path queries
+"""
+
+from yoyo import step
+
+
+__depends__ = {"20211010_01_2P6E7-add-is-anonymous-column-to-model"}
+
+steps = [
+    step(
+        "CREATE INDEX ix_examples_cid_retracted_model_wrong_total_verified "
+        + "ON examples (cid, retracted, model_wrong, total_verified)",
+        "DROP INDEX ix_examples_cid_retracted_model_wrong_total_verified "
+        + "ON examples",
+    ),
+    step(
+        "CREATE INDEX ix_validations_eid_label_mode "
+        + "ON validations (eid, label, mode)",
+        "DROP INDEX ix_validations_eid_label_mode ON validations",
+    ),
+]
@@ -2,7 +2,11 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import hashlib
+import hmac
+import logging
+import random
 import tempfile
 
 import sqlalchemy as db
@@ -19,12 +23,21 @@ from models.validation import LabelEnum, ModeEnum, Validation
 from .base import Base, BaseModel
 from .context import ContextModel
 from .task import TaskModel
-from .user import UserModel
 
 
 class Example(Base):
     __tablename__ = "examples"
-    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+    __table_args__ = (
+        # Covers the hot getRandom/getRandomFiltered filter predicates
+        db.Index(
+            "ix_examples_cid_retracted_model_wrong_total_verified",
+            "cid",
+            "retracted",
+            "model_wrong",
+            "total_verified",
+        ),
+        {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -58,15 +71,80 @@ class Example(Base):
         return f"<Example {self.id}>"
 
     def to_dict(self, safe=True):
-        d = {}
-        for column in self.__table__.columns:
-            if safe and column.name in ["split", "uid", "user"]:
-                continue
-            d[column.name] = getattr(self, column.name)
+        columns = _EXAMPLE_COLUMNS_SAFE if safe else _EXAMPLE_COLUMNS
+        d = {name: getattr(self, name) for name in columns}
         d["context"] = self.context.to_dict()
         return d
 
 
+def build_task_io(task_code, annotation_config):
+    # TaskIO only reads its task info file during construction, so hand it a
+    # short-lived tempfile that is removed on exit instead of leaking
+    # delete=False files in /tmp.
+    with tempfile.NamedTemporaryFile(mode="w+") as tmp:
+        tmp.write(
+            ujson.dumps(
+                {
+                    "annotation_config": annotation_config,
+                    "task": task_code,
+                }
+            )
+        )
+        tmp.flush()
+        return TaskIO(task_code, task_info_path=tmp.name)
+
+
+@functools.lru_cache(maxsize=256)
+def get_task_io_pair(task_code, annotation_config_json):
+    """Build the (task_io, pre_dynatask_task_io) pair for a task.
+
+    Constructing a TaskIO requires writing the task info to disk, so cache the
+    pair per (task_code, annotation_config_json) instead of re-serializing the
+    annotation config and re-writing tempfiles on every example insertion.
+    """
+    annotation_config = ujson.loads(annotation_config_json)
+    task_io = build_task_io(task_code, annotation_config)
+
+    # This is to check if we have a pre-dynatask dynalab model. Shallow-copy
+    # the parsed config and swap in the pre-dynatask fields rather than
+    # parsing the JSON a second time.
+    pre_dynatask_annotation_config = dict(annotation_config)
+    if task_code in ("hs", "sentiment"):
+        pre_dynatask_annotation_config["context"] = []
+    pre_dynatask_annotation_config["output"] = [
+        obj
+        for obj in annotation_config["output"]
+        if obj["type"] not in ("multiclass_probs", "conf")
+    ]
+    pre_dynatask_task_io = build_task_io(task_code, pre_dynatask_annotation_config)
+
+    return task_io, pre_dynatask_task_io
+
+
+@functools.lru_cache(maxsize=64)
+def _get_anon_uid_base(secret):
+    # A whole export batch shares the same secret, so hash that prefix once
+    # per secret; each uid digest then resumes from a copy of this state.
+    return hashlib.sha1(secret.encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=65536)
+def get_anon_uid(secret, uid):
+    # Export endpoints anonymize the same (secret, uid) pairs over and over,
+    # so cache the digests too.
+    anon_uid = _get_anon_uid_base(secret).copy()
+    anon_uid.update(str(uid).encode("utf-8"))
+    return anon_uid.hexdigest()
+
+
+# Computed once at import time so to_dict doesn't walk the table metadata on
+# every call.
+_EXAMPLE_COLUMNS = tuple(column.name for column in Example.__table__.columns)
+_EXAMPLE_COLUMNS_SAFE = tuple(
+    name for name in _EXAMPLE_COLUMNS if name not in ("split", "uid", "user")
+)
+
+
 class ExampleModel(BaseModel):
     def __init__(self):
         super().__init__(Example)
@@ -84,6 +162,9 @@ class ExampleModel(BaseModel):
         model_wrong,
         tag=None,
         model_endpoint_name=None,
+        input_json=None,
+        output_json=None,
+        metadata_json=None,
     ):
 
         if uid == "turk" and "annotator_id" not in metadata:
@@ -137,41 +218,9 @@ class ExampleModel(BaseModel):
                     all_model_annotation_data
                 )
 
-                with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                    annotation_config = ujson.loads(task.annotation_config_json)
-                    tmp.write(
-                        ujson.dumps(
-                            {
-                                "annotation_config": annotation_config,
-                                "task": task.task_code,
-                            }
-                        )
-                    )
-                    tmp.close()
-                    task_io = TaskIO(task.task_code, task_info_path=tmp.name)
-
-                # This is to check if we have a pre-dynatask dynalab model
-                with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmp:
-                    annotation_config = ujson.loads(task.annotation_config_json)
-                    if task.task_code in ("hs", "sentiment"):
-                        annotation_config["context"] = []
-                    annotation_config["output"] = [
-                        obj
-                        for obj in annotation_config["output"]
-                        if obj["type"] not in ("multiclass_probs", "conf")
-                    ]
-                    tmp.write(
-                        ujson.dumps(
-                            {
-                                "annotation_config": annotation_config,
-                                "task": task.task_code,
-                            }
-                        )
-                    )
-                    tmp.close()
-                    pre_dynatask_task_io = TaskIO(
-                        task.task_code, task_info_path=tmp.name
-                    )
+                task_io, pre_dynatask_task_io = get_task_io_pair(
+                    task.task_code, task.annotation_config_json
+                )
 
                 model_secret = (
                     self.dbs.query(Model)
@@ -179,51 +228,41 @@ class ExampleModel(BaseModel):
                     .one()
                     .secret
                 )
-                if model_signature not in (
-                    task_io.generate_response_signature(
-                        all_model_annotation_data,
-                        all_model_annotation_data,
-                        model_secret,
-                    ),
+                expected_signature = task_io.generate_response_signature(
+                    all_model_annotation_data,
+                    all_model_annotation_data,
+                    model_secret,
+                )
+                pre_dynatask_expected_signature = (
                     pre_dynatask_task_io.generate_response_signature(
                         all_model_annotation_data,
                         all_model_annotation_data,
                         model_secret,
-                    ),
+                    )
+                )
+                if not (
+                    hmac.compare_digest(model_signature, expected_signature)
+                    or hmac.compare_digest(
+                        model_signature, pre_dynatask_expected_signature
+                    )
                 ):
                     logger.error(
                         "Signature does not match (received %s, expected to be"
                         + " %s or %s)"
                         % (
                             model_signature,
-                            task_io.generate_response_signature(
-                                all_model_annotation_data,
-                                all_model_annotation_data,
-                                model_secret,
-                            ),
-                            pre_dynatask_task_io.generate_response_signature(
-                                all_model_annotation_data,
-                                all_model_annotation_data,
-                                model_secret,
-                            ),
+                            expected_signature,
+                            pre_dynatask_expected_signature,
                         )
                     )
                     return False
-                else:
+                elif logger.isEnabledFor(logging.INFO):
                     logger.info(
                         "Signature matches (received %s, expected to be %s or %s)"
                         % (
                             model_signature,
-                            task_io.generate_response_signature(
-                                all_model_annotation_data,
-                                all_model_annotation_data,
-                                model_secret,
-                            ),
-                            pre_dynatask_task_io.generate_response_signature(
-                                all_model_annotation_data,
-                                all_model_annotation_data,
-                                model_secret,
-                            ),
+                            expected_signature,
+                            pre_dynatask_expected_signature,
                         )
                     )
             else:
@@ -273,32 +312,46 @@ class ExampleModel(BaseModel):
                         )
 
                 if not self.verify_signature(
-                    model_signature, c, list(input.values())[0], pred
+                    model_signature,
+                    c,
+                    list(context.values())[0],
+                    list(input.values())[0],
+                    pred,
                 ):
                     return False
                 # End hack that can be removed upon full dynalab integration
 
+        # Callers that already hold the serialized form (e.g. the API layer)
+        # can pass it through; otherwise serialize each payload exactly once.
+        if input_json is None:
+            input_json = ujson.dumps(input)
+        if output_json is None:
+            output_json = ujson.dumps(output)
+        if metadata_json is None:
+            metadata_json = ujson.dumps(metadata)
+
         try:
-            e = Example(
-                context=c,
-                input_json=ujson.dumps(input),
-                output_json=ujson.dumps(output),
+            values = dict(
+                cid=c.id,
+                input_json=input_json,
+                output_json=output_json,
                 model_wrong=model_wrong,
                 generated_datetime=db.sql.func.now(),
-                metadata_json=ujson.dumps(metadata),
+                metadata_json=metadata_json,
                 tag=tag,
                 model_endpoint_name=model_endpoint_name,
             )
 
             # store uid/annotator_id
             if uid != "turk":
-                um = UserModel()
-                user = um.get(uid)
-                e.user = user
+                values["uid"] = uid
 
-            self.dbs.add(e)
-            self.dbs.flush()
+            # A plain Core INSERT skips the ORM unit-of-work bookkeeping on
+            # this write-heavy path; the row is fetched back by primary key
+            # for callers that need the mapped object.
+            insert_result = self.dbs.execute(Example.__table__.insert(), values)
             self.dbs.commit()
+            e = self.get(insert_result.inserted_primary_key[0])
             logger.info("Added example (%s)" % (e.id))
         except Exception as error_message:
             logger.error("Could not create example (%s)" % error_message)
@@ -306,11 +359,12 @@ class ExampleModel(BaseModel):
         return e
 
     # Begin hack that can be removed upon full dynalab integration
-    def verify_signature(self, signature, context, hypothesis, pred_str):
+    def verify_signature(self, signature, context, context_str, hypothesis, pred_str):
+        # context_str is the first value of the already-parsed context_json, so
+        # we don't have to parse the context a second time here.
         tid = context.round.task.id
         rid = context.round.rid
         secret = context.round.secret
-        context_str = list(ujson.loads(context.context_json).values())[0]
 
         fields_to_sign = []
         fields_to_sign.append(pred_str.encode("utf-8"))
@@ -319,20 +373,20 @@ class ExampleModel(BaseModel):
         fields_to_sign.append(hypothesis.encode("utf-8"))
         fields_to_sign.append(f"{tid}{rid}{secret}".encode("utf-8"))
 
-        h = hashlib.sha1()
-        for f in fields_to_sign:
-            h.update(f)
+        # Hash the preassembled buffer in a single call instead of one update
+        # per field, and compute the hex digest only once.
+        computed = hashlib.sha1(b"".join(fields_to_sign)).hexdigest()
 
-        if h.hexdigest() != signature:
+        if not hmac.compare_digest(computed, signature):
             logger.error(
                 "Signature does not match (received %s, expected %s [%s])"
-                % (h.hexdigest(), signature, "".join([str(x) for x in fields_to_sign]))
+                % (computed, signature, "".join([str(x) for x in fields_to_sign]))
             )
             return False
-        else:
+        elif logger.isEnabledFor(logging.INFO):
             logger.info(
                 "Signature matched (received %s, expected %s [%s])"
-                % (h.hexdigest(), signature, "".join([str(x) for x in fields_to_sign]))
+                % (computed, signature, "".join([str(x) for x in fields_to_sign]))
             )
 
         return True
@@ -340,15 +394,13 @@ class ExampleModel(BaseModel):
     # End hack that can be removed upon full dynalab integration
 
     def get_anon_uid(self, secret, uid):
-        anon_uid = hashlib.sha1()
-        anon_uid.update(secret.encode("utf-8"))
-        anon_uid.update(str(uid).encode("utf-8"))
-        return anon_uid.hexdigest()
+        return get_anon_uid(secret, uid)
 
     def getByTid(self, tid):
         try:
             return (
                 self.dbs.query(Example)
+                .options(db.orm.joinedload(Example.context))
                 .join(Context, Example.cid == Context.id)
                 .join(Round, Context.r_realid == Round.id)
                 .filter(Round.tid == tid)
@@ -361,6 +413,7 @@ class ExampleModel(BaseModel):
         try:
             return (
                 self.dbs.query(Example)
+                .options(db.orm.joinedload(Example.context))
                 .join(Context, Example.cid == Context.id)
                 .join(Round, Context.r_realid == Round.id)
                 .filter(Round.tid == tid)
@@ -394,6 +447,27 @@ class ExampleModel(BaseModel):
         except db.orm.exc.NoResultFound:
             return False
 
+    def _getRandomSample(self, query, n):
+        """Sample n examples from query without an ORDER BY RAND() filesort.
+
+        MySQL implements ORDER BY RAND() LIMIT n as a full sort over every
+        matching row. Instead, pull only (id, model_wrong, total_verified) for
+        the candidates, apply the same preference ordering with a random
+        tie-break in Python, and fetch the winners by primary key.
+        """
+        candidates = query.from_self(
+            Example.id, Example.model_wrong, Example.total_verified
+        ).all()
+        if not candidates:
+            return []
+        candidates.sort(
+            key=lambda row: (not row.model_wrong, row.total_verified, random.random())
+        )
+        ids = [row.id for row in candidates[:n]]
+        examples = self.dbs.query(Example).filter(Example.id.in_(ids)).all()
+        examples_by_id = {example.id: example for example in examples}
+        return [examples_by_id[id] for id in ids if id in examples_by_id]
+
     def getRandom(
         self,
         rid,
@@ -415,6 +489,7 @@ class ExampleModel(BaseModel):
         cnt_owner_validated = db.sql.func.sum(
             case([(Validation.mode == ModeEnum.owner, 1)], else_=0)
         ).label("cnt_owner_validated")
+        cnt_validations = db.sql.func.count(Validation.id).label("cnt_validations")
         result = (
             self.dbs.query(Example)
             .join(Context, Example.cid == Context.id)
@@ -428,41 +503,29 @@ class ExampleModel(BaseModel):
         if not validate_non_fooling:
             result = result.filter(Example.model_wrong == True)  # noqa
 
-        result_partially_validated = (
-            result.join(Validation, Example.id == Validation.eid)
-            .group_by(Validation.eid)
-            .having(
-                db.and_(
-                    cnt_correct < num_matching_validations,
-                    cnt_flagged < num_matching_validations,
-                    cnt_incorrect < num_matching_validations,
-                    cnt_owner_validated == 0,
-                )
-            )
+        if my_uid is not None:
+            result = result.filter(Example.uid != my_uid)
+
+        # A single LEFT JOIN aggregate covers both the not-yet-validated case
+        # (cnt_validations == 0) and the partially-validated case, instead of
+        # materializing two separate queries and UNIONing them.
+        partially_validated = db.and_(
+            cnt_correct < num_matching_validations,
+            cnt_flagged < num_matching_validations,
+            cnt_incorrect < num_matching_validations,
+            cnt_owner_validated == 0,
         )
         if my_uid is not None:
             cnt_uid = db.sql.func.sum(
                 case([(Validation.uid == my_uid, 1)], else_=0)
             ).label("cnt_uid")
-            result_partially_validated = result_partially_validated.group_by(
-                Validation.eid
-            ).having(cnt_uid == 0)
-        result_not_validated = result.filter(
-            db.not_(db.exists().where(Validation.eid == Example.id))
-        )
-        result = result_partially_validated.union(result_not_validated)
-        if my_uid is not None:
-            result = result.filter(Example.uid != my_uid)
+            partially_validated = db.and_(partially_validated, cnt_uid == 0)
         result = (
-            result.order_by(
-                db.not_(Example.model_wrong),
-                Example.total_verified.asc(),
-                db.sql.func.rand(),
-            )
-            .limit(n)
-            .all()
+            result.outerjoin(Validation, Example.id == Validation.eid)
+            .group_by(Example.id)
+            .having(db.or_(cnt_validations == 0, partially_validated))
         )
-        return result
+        return self._getRandomSample(result, n)
 
     def getRandomFiltered(
         self,
@@ -532,13 +595,4 @@ class ExampleModel(BaseModel):
         if min_num_disagreements == 0 and min_num_flags == 0:
             result = result.union(result_not_validated)
 
-        result = (
-            result.order_by(
-                db.not_(Example.model_wrong),
-                Example.total_verified.asc(),
-                db.sql.func.rand(),
-            )
-            .limit(n)
-            .all()
-        )
-        return result
+        return self._getRandomSample(result, n)
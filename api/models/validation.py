@@ -24,7 +24,12 @@ class ModeEnum(enum.Enum):
 
 class Validation(Base):
     __tablename__ = "validations"
-    __table_args__ = {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"}
+    __table_args__ = (
+        # Lets the per-example validation aggregates group and count from the
+        # index alone
+        db.Index("ix_validations_eid_label_mode", "eid", "label", "mode"),
+        {"mysql_charset": "utf8mb4", "mysql_collate": "utf8mb4_general_ci"},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     uid = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
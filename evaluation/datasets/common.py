@@ -9,6 +9,7 @@ import tempfile
 
 import boto3
 
+import ujson
 from eval_config import eval_config
 from metrics.metric_getters import get_delta_metrics, get_eval_metrics
 from models.dataset import AccessTypeEnum
@@ -171,11 +172,15 @@ class BaseDataset:
         self.s3_client.download_file(
             self.task.s3_bucket, self._get_data_s3_path(perturb_prefix), tf
         )
-        data = [json.loads(l) for l in open(tf).readlines()]
-        if perturb_prefix:
-            labels = [self.perturb_label_field_converter(example) for example in data]
-        else:
-            labels = [self.label_field_converter(example) for example in data]
+        # Stream the file line by line instead of materializing it in memory
+        # with readlines(), and parse with ujson's C decoder.
+        with open(tf) as f:
+            if perturb_prefix:
+                labels = [
+                    self.perturb_label_field_converter(ujson.loads(line)) for line in f
+                ]
+            else:
+                labels = [self.label_field_converter(ujson.loads(line)) for line in f]
         os.remove(tf)
         if not self._n_examples.get(perturb_prefix, None):
             self._n_examples[perturb_prefix] = len(labels)
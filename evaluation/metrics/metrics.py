@@ -2,14 +2,20 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import collections
+import fcntl
 import functools
-import subprocess
+import os
+import re
+import string
+import tempfile
+import urllib.request
 from pathlib import Path
 
+import numpy as np
 import sacrebleu
 import sentencepiece
 from sklearn.metrics import f1_score
-from transformers.data.metrics.squad_metrics import compute_f1
 
 from metrics.instance_property import instance_property
 
@@ -28,15 +34,29 @@ def get_accuracy(predictions: list, targets: list):
     neutral labels to be evaluated on a dataset with entailment, not-entailment labels.
     """
 
-    def equality(p, t):
+    if all(isinstance(t, str) for t in targets):
+        # Common case: one label per target. A single vectorized comparison
+        # instead of a Python-level equality call per example.
+        pred_arr = np.asarray(predictions)
+        tgt_arr = np.asarray(targets)
+        acc = np.count_nonzero(pred_arr == tgt_arr) / len(targets)
+        return round(acc * 100, 2)
+
+    # Multi-label targets: convert each label list to a frozenset up front so
+    # the per-example membership test is O(1) instead of scanning the list.
+    normalized_targets = []
+    for t in targets:
         if isinstance(t, list):
-            return p in t
+            normalized_targets.append(frozenset(t))
         elif isinstance(t, str):
-            return p == t
+            normalized_targets.append(t)
         else:
             raise TypeError("t must be a set of strings or a string")
 
-    acc = sum([equality(p, t) for p, t in zip(predictions, targets)]) / len(targets)
+    acc = sum(
+        p in t if isinstance(t, frozenset) else p == t
+        for p, t in zip(predictions, normalized_targets)
+    ) / len(targets)
     return round(acc * 100, 2)
 
 
@@ -44,6 +64,11 @@ def get_accuracy_meta(task=None):
     return {"unit": "%", "pretty_name": "Accuracy", "utility_direction": 1, "offset": 0}
 
 
+# VQAEval holds no per-call state, so build it once at import time rather than
+# on every get_vqa_accuracy call.
+_vqa_eval = VQAEval()
+
+
 def get_vqa_accuracy(predictions: list, targets: list):
     """
     prediction format: [
@@ -62,12 +87,11 @@ def get_vqa_accuracy(predictions: list, targets: list):
     Target format can also be the same as the prediction format (in this case it is
     assumed that there is only one answer, not a list of answers)
     """
-    vqa_eval = VQAEval()
     acc_vqa = [
-        vqa_eval(list(t) if isinstance(t, str) else t, p)
+        _vqa_eval(list(t) if isinstance(t, str) else t, p)
         for p, t in zip(predictions, targets)
     ]
-    return round(100 * float(sum(acc_vqa)) / len(acc_vqa), vqa_eval.n)
+    return round(100 * float(sum(acc_vqa)) / len(acc_vqa), _vqa_eval.n)
 
 
 def get_vqa_accuracy_meta(task=None):
@@ -80,7 +104,7 @@ def get_vqa_accuracy_meta(task=None):
 
 
 def get_macro_f1(predictions: list, targets: list):
-    macro_f1 = f1_score(targets, predictions, average="macro")
+    macro_f1 = f1_score(np.asarray(targets), np.asarray(predictions), average="macro")
     return round(macro_f1 * 100, 2)
 
 
@@ -88,6 +112,30 @@ def get_macro_f1_meta(task=None):
     return {"unit": "%", "pretty_name": "Macro F1", "utility_direction": 1, "offset": 0}
 
 
+_articles_re = re.compile(r"\b(a|an|the)\b")
+_punc_table = str.maketrans("", "", string.punctuation)
+
+
+def _squad_tokens(text: str) -> list:
+    """Normalize and tokenize an answer, per the squad evaluation script."""
+    if not text:
+        return []
+    return _articles_re.sub(" ", text.lower().translate(_punc_table)).split()
+
+
+def _squad_f1(gold_toks: list, pred_toks: list, pred_counter) -> float:
+    """F1 between two pre-tokenized answers, per the squad evaluation script."""
+    if len(gold_toks) == 0 or len(pred_toks) == 0:
+        # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+        return int(gold_toks == pred_toks)
+    num_same = sum((collections.Counter(gold_toks) & pred_counter).values())
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / len(pred_toks)
+    recall = 1.0 * num_same / len(gold_toks)
+    return (2 * precision * recall) / (precision + recall)
+
+
 def get_squad_f1(predictions: list, targets: list):
     """
     Here, t can be a list of acceptable answers, instead of just one answer. There
@@ -97,18 +145,29 @@ def get_squad_f1(predictions: list, targets: list):
     squad evaluation standard.
     """
 
-    def squad_f1_loop(t, p):
+    def squad_f1_loop(t, pred_toks, pred_counter):
         if isinstance(t, list):
             if len(t) == 0:
                 # Per the squad evaluation script
                 t = [""]
-            return max([compute_f1(t_answer, p) for t_answer in t])
+            return max(
+                [
+                    _squad_f1(_squad_tokens(t_answer), pred_toks, pred_counter)
+                    for t_answer in t
+                ]
+            )
         elif isinstance(t, str):
-            return compute_f1(t, p)
+            return _squad_f1(_squad_tokens(t), pred_toks, pred_counter)
         else:
             raise TypeError("t must be a list of strings or a string")
 
-    f1 = sum([squad_f1_loop(t, p) for p, t in zip(predictions, targets)]) / len(targets)
+    # Each prediction is normalized and counted once, instead of once per
+    # acceptable answer inside compute_f1.
+    f1 = 0.0
+    for p, t in zip(predictions, targets):
+        pred_toks = _squad_tokens(p)
+        f1 += squad_f1_loop(t, pred_toks, collections.Counter(pred_toks))
+    f1 /= len(targets)
     return round(f1 * 100, 2)
 
 
@@ -155,24 +214,46 @@ SPM_URL = (
 SPM_PATH = Path(__file__).parent / "sentencepiece.bpe.model"
 
 
+def _download_spm_model():
+    # Serialize concurrent workers on a lockfile so only one downloads, and
+    # download to a tempfile + atomic rename so nobody reads a partial model.
+    with open(SPM_PATH.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if SPM_PATH.exists():
+                return
+            tmp = tempfile.NamedTemporaryFile(dir=SPM_PATH.parent, delete=False)
+            tmp.close()
+            try:
+                urllib.request.urlretrieve(SPM_URL, tmp.name)
+                os.replace(tmp.name, SPM_PATH)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
 @functools.lru_cache()
 def get_spm_model():
     if not SPM_PATH.exists():
-        subprocess.check_call(["wget", SPM_URL, "-O", str(SPM_PATH)])
+        _download_spm_model()
     spm = sentencepiece.SentencePieceProcessor()
     assert spm.Load(str(SPM_PATH)), f"Couldn't load spm model from {SPM_PATH}"
     return spm
 
 
-def sp_tokenize(spm, sentence: str) -> str:
-    words = spm.EncodeAsPieces(sentence.strip())
-    return " ".join(words)
+def sp_tokenize(spm, sentences: list) -> list:
+    # Batch encode so the whole list crosses the Python/C++ boundary in one
+    # call instead of once per sentence.
+    pieces = spm.encode([sentence.strip() for sentence in sentences], out_type=str)
+    return [" ".join(words) for words in pieces]
 
 
 def get_sp_bleu(predictions: list, targets: list):
     spm = get_spm_model()
-    spm_pred = [sp_tokenize(spm, pred) for pred in predictions]
-    spm_targets = [sp_tokenize(spm, tgt) for tgt in targets]
+    spm_pred = sp_tokenize(spm, predictions)
+    spm_targets = sp_tokenize(spm, targets)
     bleu = sacrebleu.corpus_bleu(spm_pred, [spm_targets], force=True)
     return bleu.score
 
@@ -209,12 +209,13 @@ class VQAEval(ABC):
             processed_gt.append(ans)
         gtAcc = []
         #######################################################
-        for idx, gtAnsDatum in enumerate(processed_gt):
-            otherGTAns = [
-                item for item_idx, item in enumerate(processed_gt) if item_idx != idx
-            ]
-            matchingAns = [item for item in otherGTAns if item == resAns]
-            acc = min(1, float(len(matchingAns)) / 3)
+        # For each ground-truth answer we need the number of *other* answers
+        # matching the response. Count the matches once and subtract the
+        # held-out answer, instead of rebuilding the answer list per element.
+        totalMatching = processed_gt.count(resAns)
+        for gtAnsDatum in processed_gt:
+            matching = totalMatching - (1 if gtAnsDatum == resAns else 0)
+            acc = min(1, float(matching) / 3)
             gtAcc.append(acc)
         #######################################################
         avgGTAcc = float(sum(gtAcc)) / len(gtAcc)